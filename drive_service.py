@@ -1,49 +1,60 @@
 from __future__ import annotations
 from dataclasses import dataclass
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+from itertools import chain
 from mimetypes import guess_type
 from pathlib import Path
-from typing import Sequence
+from typing import Iterable, Sequence
 
+import httplib2
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp, Request
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import BatchHttpRequest, HttpRequest, MediaIoBaseUpload
 
 FileId = str
 
 
-@dataclass(order=True)
+@dataclass(slots=True)
 class FileInfo:
     path: Path
     id: str
     parent: DirInfo
+    # Only known if the owners were requested when listing
+    owned_by_service: bool | None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class DirInfo:
     path: Path
     id: FileId
     parent: DirInfo | None
 
 
-@dataclass(order=True)
+@dataclass(slots=True)
 class UploadTarget:
     path: Path
     folder: DirInfo
+    size: int
 
 
-@dataclass(order=True)
+@dataclass(slots=True)
 class UploadInfo:
     target: UploadTarget
     existing_info: FileInfo | None
 
 
-@dataclass
+@dataclass(slots=True)
 class FolderTree:
     dir: DirInfo | None
     children: dict[str, FolderTree]
 
 
+FolderIndex = dict[tuple[str, ...], DirInfo]
+
+
 SCOPES = [
     "https://www.googleapis.com/auth/drive.metadata.readonly",
     "https://www.googleapis.com/auth/drive.file",
@@ -52,47 +63,251 @@ SCOPES = [
 
 FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
 
+
+def _q_escape(s: str) -> str:
+    """Escape a value for use inside a quoted string of a drive query."""
+    return s.replace("\\", "\\\\").replace("'", "\\'")
+
+
+# Query templates. Arguments have to be escaped using _q_escape.
+IN_FOLDER_QUERY = "'{folder}' in parents and trashed = false"
+NAMED_IN_FOLDER_QUERY = "'{folder}' in parents and name = '{name}' and trashed = false"
+FOLDERS_QUERY = f"mimeType = '{FOLDER_MIME_TYPE}'"
+OWNED_FILES_QUERY = f"'{{owner}}' in owners and mimeType != '{FOLDER_MIME_TYPE}'"
+SNAPSHOT_QUERY = f"trashed = false and ('{{owner}}' in owners or mimeType = '{FOLDER_MIME_TYPE}')"
+
 RETRIES = 5
 
+# Files smaller than this are uploaded in a single request instead of a resumable upload
+SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024
+
+# Chunk size of resumable uploads
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Maximal number of entries the drive api returns per page of a listing
+PAGE_SIZE = 1000
+
+# Maximal number of requests the drive api accepts in a single batch
+MAX_BATCH_SIZE = 100
+
+# Maximal number of batches which are in flight at the same time
+BATCH_CONCURRENCY = 8
+
+# Maximal number of folders which are listed at the same time when fetching a folder tree
+TREE_FETCH_CONCURRENCY = 16
+
+
+def index_folder_tree(tree: FolderTree) -> FolderIndex:
+    """Index all folders by their path parts relative to the root, which is indexed by ()."""
+    index: FolderIndex = {}
+    stack: list[tuple[FolderTree, tuple[str, ...]]] = [(tree, ())]
+    while stack:
+        node, parts = stack.pop()
+        if node.dir:
+            index[parts] = node.dir
+        for name, child in node.children.items():
+            stack.append((child, parts + (name,)))
+    return index
+
+
+def _children_by_parent(snapshot: dict[FileId, dict]) -> dict[FileId, list[dict]]:
+    children: dict[FileId, list[dict]] = {}
+    for entry in snapshot.values():
+        for parent in entry.get("parents", []):
+            children.setdefault(parent, []).append(entry)
+    return children
+
+
+def folder_tree_from_snapshot(snapshot: dict[FileId, dict], folder: DirInfo) -> FolderTree:
+    """Build the folder tree below `folder` from a DriveService.snapshot_all result."""
+    children = _children_by_parent(snapshot)
+    root = FolderTree(dir=folder, children={})
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        assert node.dir is not None
+        for entry in children.get(node.dir.id, []):
+            name = entry["name"]
+            if entry["mimeType"] != FOLDER_MIME_TYPE or name in node.children:
+                continue
+            child = FolderTree(
+                dir=DirInfo(node.dir.path / name, entry["id"], node.dir), children={}
+            )
+            node.children[name] = child
+            stack.append(child)
+    return root
+
+
+def files_from_snapshot(snapshot: dict[FileId, dict], folders: Iterable[DirInfo]) -> list[FileInfo]:
+    """Look up the files of `folders` in a DriveService.snapshot_all result."""
+    children = _children_by_parent(snapshot)
+    return [
+        FileInfo(folder.path / entry["name"], entry["id"], folder)
+        for folder in folders
+        for entry in children.get(folder.id, [])
+        if entry["mimeType"] != FOLDER_MIME_TYPE
+    ]
+
+
 class DriveService:
     def __init__(self, credentials_json: dict):
         self.service_account_mail = credentials_json["client_email"]
         credentials = service_account.Credentials.from_service_account_info(
             credentials_json, scopes=SCOPES
         )
-        self.service = build("drive", "v3", credentials=credentials)
+        # Fetch the access token up front. Otherwise the threads issuing the first requests
+        # would all notice the missing token and each request a new one.
+        credentials.refresh(Request(httplib2.Http()))
+        self.credentials = credentials
+        self.service = build("drive", "v3", http=self._authorized_http())
+        self._local = threading.local()
+        # Shared by all calls, such that the threads keep their transports and connections alive.
+        self._batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
 
-    def list_in_folder(self, folder: DirInfo, query: str) -> list[FileInfo]:
-        results = (
-            self.service.files()
-            .list(
-                q=f"""
-                    '{folder.id}' in parents
-                    {'and' if query else ''}
-                    {query}
-                    """,
-                fields="files(id, name)",
+    def _authorized_http(self) -> AuthorizedHttp:
+        # All transports share the same credentials and thus the same access token.
+        return AuthorizedHttp(self.credentials, http=httplib2.Http())
+
+    def _http(self) -> AuthorizedHttp:
+        # httplib2.Http is not thread-safe, hence each thread gets its own transport
+        # which has to be passed explicitly to execute() / next_chunk().
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._authorized_http()
+            self._local.http = http
+        return http
+
+    def _execute_batched(
+        self, requests: dict[str, HttpRequest], concurrent: bool
+    ) -> dict[str, dict]:
+        """
+        Execute the requests in batches of MAX_BATCH_SIZE and return the responses by request id.
+        Only reads should be executed concurrently, write batches are executed one after another
+        to stay clear of the write rate limits of the drive api.
+        """
+        responses: dict[str, dict] = {}
+        failed: list[str] = []
+        lock = threading.Lock()
+
+        def callback(request_id, response, exception):
+            with lock:
+                if exception:
+                    failed.append(request_id)
+                else:
+                    responses[request_id] = response
+
+        ids = list(requests)
+        batches = []
+        for i in range(0, len(ids), MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for request_id in ids[i : i + MAX_BATCH_SIZE]:
+                batch.add(requests[request_id], request_id=request_id)
+            batches.append(batch)
+
+        def execute(batch: BatchHttpRequest) -> None:
+            batch.execute(http=self._http())
+
+        if concurrent and len(batches) > 1:
+            list(self._batch_executor.map(execute, batches))
+        else:
+            for batch in batches:
+                execute(batch)
+
+        # Requests inside a batch aren't retried, hence fall back to individual requests.
+        for request_id in failed:
+            responses[request_id] = requests[request_id].execute(
+                http=self._http(), num_retries=RETRIES
             )
-            .execute(num_retries=RETRIES)
+        return responses
+
+    def _list_request(
+        self, folder: DirInfo, query: str, page_token: str | None = None, with_owners: bool = False
+    ):
+        return self.service.files().list(
+            q=" and ".join(
+                filter(None, [IN_FOLDER_QUERY.format(folder=_q_escape(folder.id)), query])
+            ),
+            fields=(
+                "nextPageToken, files(id, name, owners(emailAddress))"
+                if with_owners
+                else "nextPageToken, files(id, name)"
+            ),
+            pageSize=PAGE_SIZE,
+            pageToken=page_token,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
         )
-        return [
-            FileInfo(folder.path / f["name"], f["id"], folder)
-            for f in results.get("files", [])
-        ]
 
-    def list_files_in_folder(self, folder: DirInfo) -> list[FileInfo]:
-        return self.list_in_folder(
-            folder=folder,
-            query=f"'{self.service_account_mail}' in owners and mimeType != '{FOLDER_MIME_TYPE}'",
+    def list_in_folder(self, folder: DirInfo, query: str) -> list[FileInfo]:
+        files = []
+        request = self._list_request(folder, query)
+        while request is not None:
+            results = request.execute(http=self._http(), num_retries=RETRIES)
+            files.extend(results.get("files", []))
+            request = self.service.files().list_next(request, results)
+        return [FileInfo(folder.path / f["name"], f["id"], folder) for f in files]
+
+    def batch_list_in_folders(
+        self, folders: Sequence[DirInfo], query: str, with_owners: bool = False
+    ) -> dict[FileId, list[FileInfo]]:
+        """
+        Same as list_in_folder for multiple folders at once, issuing one batched request
+        per MAX_BATCH_SIZE folders. Returns the entries of each folder keyed by the folder id.
+        With `with_owners`, the entries also tell whether they are owned by the service account.
+        """
+        folders_by_id = {folder.id: folder for folder in folders}
+        result: dict[FileId, list[FileInfo]] = {fid: [] for fid in folders_by_id}
+        # Folders which still have pages left to fetch, with the token of the next page
+        pending: dict[FileId, str | None] = {fid: None for fid in folders_by_id}
+
+        while pending:
+            responses = self._execute_batched(
+                {
+                    fid: self._list_request(folders_by_id[fid], query, page_token, with_owners)
+                    for fid, page_token in pending.items()
+                },
+                concurrent=True,
+            )
+            pending = {}
+            for fid, response in responses.items():
+                folder = folders_by_id[fid]
+                result[fid].extend(
+                    FileInfo(
+                        folder.path / f["name"],
+                        f["id"],
+                        folder,
+                        self._is_sole_owner(f) if with_owners else None,
+                    )
+                    for f in response.get("files", [])
+                )
+                if response.get("nextPageToken"):
+                    pending[fid] = response["nextPageToken"]
+        return result
+
+    def batch_list_files_in_folders(self, folders: Sequence[DirInfo]) -> list[FileInfo]:
+        return list(
+            chain.from_iterable(
+                self.batch_list_in_folders(folders, query=self._files_query()).values()
+            )
         )
 
+    def _files_query(self) -> str:
+        return OWNED_FILES_QUERY.format(owner=_q_escape(self.service_account_mail))
+
     def is_owned_by_service(self, fileOrFolder: FileInfo | DirInfo) -> bool:
         results = (
             self.service.files()
-            .get(fileId=fileOrFolder.id, fields="owners")
+            .get(
+                fileId=fileOrFolder.id,
+                fields="owners(emailAddress)",
+                supportsAllDrives=True,
+            )
             .execute(num_retries=RETRIES)
         )
-        owners = results.get("owners", [])
+        return self._is_sole_owner(results)
+
+    def _is_sole_owner(self, file: dict) -> bool:
+        owners = file.get("owners", [])
         return len(owners) == 1 and owners[0]["emailAddress"] == self.service_account_mail
 
     def list_folders_in_folder(self, folder: DirInfo) -> list[DirInfo]:
@@ -100,40 +315,63 @@ class DriveService:
             DirInfo(f.path, f.id, f.parent)
             for f in self.list_in_folder(
                 folder=folder,
-                query=f"'{self.service_account_mail}' in owners and mimeType = '{FOLDER_MIME_TYPE}'",
+                query=FOLDERS_QUERY,
             )
         ]
 
-    def is_folder_empty(self, folder: DirInfo) -> bool:
-        entries = self.list_in_folder(folder=folder, query="")
-        return len(entries) == 0
-
     def fetch_remote_folder_tree(self, folder: DirInfo) -> FolderTree:
-        def build_tree(folder: DirInfo, current_node: FolderTree) -> None:
-            folders = self.list_folders_in_folder(folder)
-            for folder in folders:
-                last = folder.path.parts[-1]
-                if last not in current_node.children:
-                    node = FolderTree(dir=folder, children={})
-                    current_node.children[last] = node
-                    build_tree(folder, node)
-
         root = FolderTree(dir=folder, children={})
-        build_tree(folder, root)
+        # Folders are listed concurrently, while the tree is only modified by this thread.
+        with ThreadPoolExecutor(max_workers=TREE_FETCH_CONCURRENCY) as executor:
+            in_flight = {executor.submit(self.list_folders_in_folder, folder): root}
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    current_node = in_flight.pop(future)
+                    for child in future.result():
+                        last = child.path.parts[-1]
+                        if last not in current_node.children:
+                            node = FolderTree(dir=child, children={})
+                            current_node.children[last] = node
+                            in_flight[executor.submit(self.list_folders_in_folder, child)] = node
         return root
 
+    def snapshot_all(self) -> dict[FileId, dict]:
+        """
+        Fetch all folders and all files owned by the service account with a single paginated listing.
+        Its content matches what fetch_remote_folder_tree and batch_list_files_in_folders would return
+        for any folder, which allows rebuilding their results without issuing a request per folder.
+        """
+        snapshot: dict[FileId, dict] = {}
+        request = self.service.files().list(
+            q=SNAPSHOT_QUERY.format(owner=_q_escape(self.service_account_mail)),
+            fields="nextPageToken, files(id, name, mimeType, parents)",
+            pageSize=PAGE_SIZE,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        )
+        while request is not None:
+            results = request.execute(num_retries=RETRIES)
+            for f in results.get("files", []):
+                snapshot[f["id"]] = f
+            request = self.service.files().list_next(request, results)
+        return snapshot
+
     def ensure_path(self, path: Path, base: DirInfo) -> DirInfo:
         current = base
         for part in path.parts:
-            results = (
-                self.service.files()
-                .list(
-                    q=f"'{current.id}' in parents and name = '{part}'",
-                    fields="files(id)",
-                )
-                .execute(num_retries=RETRIES)
+            # Pages may be empty before the end of the results, hence follow them until a match is found.
+            folders = []
+            request = self.service.files().list(
+                q=NAMED_IN_FOLDER_QUERY.format(folder=_q_escape(current.id), name=_q_escape(part)),
+                fields="nextPageToken, files(id)",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
             )
-            folders = results.get("files", [])
+            while request is not None and not folders:
+                results = request.execute(num_retries=RETRIES)
+                folders = results.get("files", [])
+                request = self.service.files().list_next(request, results)
             if folders:
                 current = DirInfo(current.path / part, folders[0]["id"], current)
             else:
@@ -150,6 +388,7 @@ class DriveService:
                             "parents": [current.id],
                         },
                         fields="id",
+                        supportsAllDrives=True,
                     )
                     .execute(num_retries=RETRIES)
                 )
@@ -160,21 +399,80 @@ class DriveService:
 
         return current
 
-    def delete(self, file: FileInfo | DirInfo) -> None:
-        self.service.files().delete(fileId=file.id).execute(num_retries=RETRIES)
+    def ensure_paths(self, index: FolderIndex, paths: Iterable[Path]) -> None:
+        """
+        Same as ensure_path for multiple paths relative to the root of `index`, but existing folders
+        are looked up in `index` instead of being requested. Missing folders are created and added to `index`.
+        """
+        missing: set[tuple[str, ...]] = set()
+        for path in paths:
+            parts = path.parts
+            for depth in range(len(parts), 0, -1):
+                if parts[:depth] in index:
+                    break
+                missing.add(parts[:depth])
+        self.create_folders(index, missing)
 
-    def batch_delete(self, files: Sequence[FileInfo | DirInfo]) -> None:
+    def create_folders(self, index: FolderIndex, paths: Iterable[tuple[str, ...]]) -> None:
+        """
+        Create all folders given as path parts relative to the root of `index` which don't exist yet.
+        The parents of each path have to be contained in `paths` or exist in `index`.
+        Folders are created in batches, one level of depth at a time, and inserted into `index`.
+        """
+        by_depth: dict[int, set[tuple[str, ...]]] = {}
+        for parts in paths:
+            by_depth.setdefault(len(parts), set()).add(parts)
+
+        for depth in sorted(by_depth):
+            pending: list[tuple[str, ...]] = []
+            for parts in sorted(by_depth[depth]):
+                if parts[:-1] not in index:
+                    raise Exception(f"Parent of folder {Path(*parts)} does not exist")
+                if parts not in index:
+                    print(f"Folder {index[parts[:-1]].path / parts[-1]} does not exist in drive. Create it.")
+                    pending.append(parts)
+
+            responses = self._execute_batched(
+                {
+                    str(request_id): self._create_folder_request(index[parts[:-1]], parts[-1])
+                    for request_id, parts in enumerate(pending)
+                },
+                concurrent=False,
+            )
+
+            for request_id, parts in enumerate(pending):
+                parent = index[parts[:-1]]
+                fid = responses.get(str(request_id), {}).get("id")
+                if not fid:
+                    raise Exception(f"Could not create folder {parent.path / parts[-1]}")
+                index[parts] = DirInfo(parent.path / parts[-1], fid, parent)
+
+    def _create_folder_request(self, parent: DirInfo, name: str):
+        return self.service.files().create(
+            body={
+                "name": name,
+                "mimeType": FOLDER_MIME_TYPE,
+                "parents": [parent.id],
+            },
+            fields="id",
+            supportsAllDrives=True,
+        )
+
+    def batch_delete(
+        self, files: Sequence[FileInfo | DirInfo], description: str = "stale file"
+    ) -> None:
         if not files:
             return
         def callback(_requ, _resp, exception):
             if exception:
                 print(f"An error occurred: {exception}")
 
-        batch = self.service.new_batch_http_request(callback=callback)
-        for file in files:
-            print(f"Delete stale file {file.path} ({file.id})")
-            batch.add(self.service.files().delete(fileId=file.id))
-        batch.execute()
+        for i in range(0, len(files), MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for file in files[i : i + MAX_BATCH_SIZE]:
+                print(f"Delete {description} {file.path} ({file.id})")
+                batch.add(self.service.files().delete(fileId=file.id, supportsAllDrives=True))
+            batch.execute()
         print(f"    ==> Done deleting {len(files)} files.")
 
     def upload_file(self, input_folder: Path, upload_info: UploadInfo) -> None:
@@ -184,28 +482,40 @@ class DriveService:
         mime, _ = guess_type(file)
         if mime is None:
             mime = "*/*"
-        media = MediaFileUpload(
-            input_folder / file, chunksize=1024 * 1024, mimetype=mime, resumable=True
-        )
-        if info is None:
-            print(f"Upload new file {file.name}")
-            request = self.service.files().create(
-                body={
-                    "name": file.name,
-                    "parents": [folder.id],
-                },
-                media_body=media,
-                fields="id",
-            )
-        else:
-            print(f"Update existing file {file.name}")
-            request = self.service.files().update(
-                fileId=info.id,
-                media_body=media,
+        # Small files are sent in a single multipart request, which saves the round-trips
+        # for initiating the resumable upload session and uploading individual chunks.
+        resumable = upload_info.target.size >= SIMPLE_UPLOAD_LIMIT
+        # The file is opened once for all chunks and retries, and closed as soon as the upload is done.
+        with open(input_folder / file, "rb") as fh:
+            media = MediaIoBaseUpload(
+                fh, mimetype=mime, chunksize=UPLOAD_CHUNK_SIZE, resumable=resumable
             )
-        response = None
-        while response is None:
-            status, response = request.next_chunk(num_retries=RETRIES)
-            if status:
-                print("...Uploaded %d%%." % int(status.progress() * 100))
+            if info is None:
+                print(f"Upload new file {file.name}")
+                request = self.service.files().create(
+                    body={
+                        "name": file.name,
+                        "parents": [folder.id],
+                    },
+                    media_body=media,
+                    fields="id",
+                    supportsAllDrives=True,
+                )
+            else:
+                print(f"Update existing file {file.name}")
+                request = self.service.files().update(
+                    fileId=info.id,
+                    media_body=media,
+                    fields="id",
+                    supportsAllDrives=True,
+                )
+            http = self._http()
+            if not resumable:
+                request.execute(http=http, num_retries=RETRIES)
+            else:
+                response = None
+                while response is None:
+                    status, response = request.next_chunk(http=http, num_retries=RETRIES)
+                    if status:
+                        print("...Uploaded %d%%." % int(status.progress() * 100))
         print(f"    ==> Upload of {file.name} is complete.")
@@ -5,16 +5,22 @@ import sys
 import base64
 import json
 from pathlib import Path
-from itertools import chain
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 import argparse
 
 from drive_service import (
     DriveService,
     DirInfo,
+    FileId,
     UploadTarget,
     UploadInfo,
     FolderTree,
+    FolderIndex,
+    index_folder_tree,
+    folder_tree_from_snapshot,
+    files_from_snapshot,
 )
 
 def decode_credentials(credentials_base64: str) -> dict:
@@ -25,49 +31,100 @@ def load_credentials(credentials_arg: str) -> dict:
         return json.load(open(credentials_arg))
     return decode_credentials(credentials_arg)
 
-def safe_chdir(path: Path | str) -> None:
-    try:
-        os.chdir(path)
-    except Exception as e:
-        print(f"::error Failed to change directory to {path}: {e}")
-        sys.exit(1)
+def walk_files(root: Path, pattern: str) -> Iterator[tuple[Path, int]]:
+    """
+    Same as the files of `root.rglob(pattern)`, yielding paths relative to `root` together with their size.
+    Uses os.scandir, whose entries know their type from the directory listing without an extra stat call.
+    """
+    if "**" in pattern:
+        # Path.match doesn't support recursive wildcards
+        for f in root.rglob(pattern):
+            if f.is_file():
+                yield f.relative_to(root), f.stat().st_size
+        return
+    stack = [Path()]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = os.scandir(root / folder)
+        except PermissionError:
+            # Like rglob, skip directories which can't be read
+            continue
+        with entries:
+            for entry in entries:
+                path = folder / entry.name
+                # Like rglob, don't follow symlinks to directories
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file() and path.match(pattern):
+                    yield path, entry.stat().st_size
+
+def find_input_files(input_folder: Path, globFilter: str, deterministic: bool) -> list[tuple[Path, int]]:
+    """Returns the matching files relative to `input_folder` together with their size."""
+    # Doesn't change the working directory, as this runs concurrently to the remote requests.
+    input_files = list(walk_files(input_folder, globFilter))
+    if deterministic:
+        input_files.sort()
+    return input_files
 
 def get_upload_targets(
     driveService: DriveService,
-    input_folder: Path,
-    globFilter: str,
-    output_folder: DirInfo,
+    input_files: list[tuple[Path, int]],
+    remote_index: FolderIndex,
 ) -> list[UploadTarget]:
-    cwd = os.getcwd()
-    safe_chdir(input_folder)
-    input_files = sorted(f for f in Path("./").rglob(globFilter) if f.is_file())
-    safe_chdir(cwd)
+    unique_parents = {f.parent for f, _ in input_files}
+    driveService.ensure_paths(remote_index, unique_parents)
+
+    # Largest files first, such that a large file started last doesn't dominate the total upload time.
     return [
-        UploadTarget(
-            path=f,
-            folder=driveService.ensure_path(f.parent, base=output_folder),
-        )
-        for f in input_files
+        UploadTarget(path=f, folder=remote_index[f.parent.parts], size=size)
+        for f, size in sorted(input_files, key=lambda entry: -entry[1])
     ]
 
 def tree_to_list(tree: FolderTree) -> list[DirInfo]:
-    result = [tree.dir] if tree.dir else []
-    for child in tree.children.values():
-        if child.dir:
-            result.append(child.dir)
-        result.extend(tree_to_list(child))
+    result = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.dir:
+            result.append(node.dir)
+        stack.extend(node.children.values())
     return result
 
-def cleanup_folders(driveService: DriveService, folder: FolderTree) -> None:
-    def do_clean(folder: FolderTree) -> None:
+def cleanup_folders(driveService: DriveService, tree: FolderTree) -> None:
+    entries = driveService.batch_list_in_folders(tree_to_list(tree), query="", with_owners=True)
+    # The ownership of each folder is known from the listing of its parent, except for the root.
+    owned = {e.id for es in entries.values() for e in es if e.owned_by_service}
+
+    def is_owned(folder: DirInfo) -> bool:
+        if folder is tree.dir:
+            return driveService.is_owned_by_service(folder)
+        return folder.id in owned
+
+    # Post-order: a folder can be deleted if all of its entries are deletable folders.
+    deletable: set[FileId] = set()
+    def find_deletable(folder: FolderTree) -> None:
+        for child in folder.children.values():
+            find_deletable(child)
+        if (
+            folder.dir
+            and all(e.id in deletable for e in entries[folder.dir.id])
+            and is_owned(folder.dir)
+        ):
+            deletable.add(folder.dir.id)
+
+    # Deleting a folder deletes its content as well, hence only delete the topmost folders.
+    to_delete: list[DirInfo] = []
+    def collect_topmost(folder: FolderTree) -> None:
+        if folder.dir and folder.dir.id in deletable:
+            to_delete.append(folder.dir)
+            return
         for child in folder.children.values():
-            do_clean(child)
-        if folder.dir and driveService.is_folder_empty(folder.dir) and driveService.is_owned_by_service(folder.dir):
-            print(f"Delete empty folder {folder.dir.path} ({folder.dir.id})")
-            driveService.delete(folder.dir)
-            print(f"    ==> Done")
+            collect_topmost(child)
 
-    do_clean(folder)
+    find_deletable(tree)
+    collect_topmost(tree)
+    driveService.batch_delete(to_delete, description="empty folder")
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -123,6 +180,32 @@ def main() -> None:
         default=False,
         const=True,
     )
+    parser.add_argument(
+        "--no-snapshot",
+        help="Fetch the remote folders one by one instead of listing all files accessible to the service account at once. "
+        "Use this if the service account has access to a large number of unrelated files",
+        nargs="?",
+        type=bool,
+        default=False,
+        const=True,
+    )
+    parser.add_argument(
+        "--deterministic",
+        help="Process the local files in a deterministic order, e.g. for reproducible logs",
+        nargs="?",
+        type=bool,
+        default=False,
+        const=True,
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        help="Number of files which are uploaded in parallel",
+        nargs=1,
+        type=int,
+        default=[8],
+        required=False,
+    )
     args = parser.parse_args()
 
     print("==== Arguments ====")
@@ -134,17 +217,42 @@ def main() -> None:
     input_folder_path = Path(args.input[0])
     globFilter: str = args.filter[0]
     output_folder_path = Path(args.output[0])
+    concurrency: int = args.concurrency[0]
 
     if not input_folder_path.exists():
         raise FileNotFoundError(f"Input folder {input_folder_path} does not exist")
     if not input_folder_path.is_dir():
         raise NotADirectoryError(f"Input folder {input_folder_path} is not a directory")
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1 but is {concurrency}")
+
+    # Walk the local files while the remote state is being fetched
+    walk_executor = ThreadPoolExecutor(max_workers=1)
+    input_files_future = walk_executor.submit(
+        find_input_files, input_folder_path, globFilter, args.deterministic
+    )
+    walk_executor.shutdown(wait=False)
 
     driveService = DriveService(credentials_json)
 
     base_folder = DirInfo(Path(""), target_id, None)
-    output_folder = driveService.ensure_path(output_folder_path, base=base_folder)
-    upload_targets = get_upload_targets(driveService, input_folder_path, globFilter, output_folder)
+    if args.no_snapshot:
+        snapshot = None
+        output_folder = driveService.ensure_path(output_folder_path, base=base_folder)
+    else:
+        snapshot = driveService.snapshot_all()
+        base_index = index_folder_tree(folder_tree_from_snapshot(snapshot, base_folder))
+        driveService.ensure_paths(base_index, [output_folder_path])
+        output_folder = base_index[output_folder_path.parts]
+
+    # Prevent remote paths to include the path of the output folder
+    remote_base = DirInfo(Path(""), output_folder.id, None)
+    if snapshot is None:
+        remote_folder_tree = driveService.fetch_remote_folder_tree(remote_base)
+    else:
+        remote_folder_tree = folder_tree_from_snapshot(snapshot, remote_base)
+    remote_index = index_folder_tree(remote_folder_tree)
+    upload_targets = get_upload_targets(driveService, input_files_future.result(), remote_index)
 
     print("==== Local files ====")
     for input_file in upload_targets:
@@ -154,9 +262,6 @@ def main() -> None:
         t.folder.id: t.folder for t in upload_targets
     }
 
-    # Prevent remote paths to include the path of the output folder
-    remote_base = DirInfo(Path(""), output_folder.id, None)
-    remote_folder_tree = driveService.fetch_remote_folder_tree(remote_base)
     remote_folders_to_consider = {
         t.id: t for t in tree_to_list(remote_folder_tree)
     }
@@ -166,12 +271,10 @@ def main() -> None:
     for fid, folder in folders_to_consider.items():
         print(f"{folder.path} ({fid})")
 
-    remote_files = list(
-        chain.from_iterable(
-            driveService.list_files_in_folder(folder)
-            for (_, folder) in folders_to_consider.items()
-        )
-    )
+    if snapshot is None:
+        remote_files = driveService.batch_list_files_in_folders(list(folders_to_consider.values()))
+    else:
+        remote_files = files_from_snapshot(snapshot, folders_to_consider.values())
 
     print("==== Remote files ====")
     for f in remote_files:
@@ -186,8 +289,14 @@ def main() -> None:
         )
         for f in upload_targets
     ]
-    for upload_info in files_to_upload:
-        driveService.upload_file(input_folder_path, upload_info)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Consume the results to propagate any exception raised during an upload
+        list(
+            executor.map(
+                lambda upload_info: driveService.upload_file(input_folder_path, upload_info),
+                files_to_upload,
+            )
+        )
 
     if args.purge_stale:
         print("==== Removing stale remote files ====")